@@ -22,10 +22,17 @@ import json
 import logging
 import random
 import re
+import sqlite3
+import sys
+import time
+import zlib
+from collections import OrderedDict
 from datetime import date, datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, Mapping, Tuple
+from typing import Callable, Iterable, Mapping, TextIO, Tuple
 
+import numpy as np
 import pandas as pd
 import jdatetime
 
@@ -109,6 +116,16 @@ OPTIONAL_COLUMN_ALIASES: Mapping[str, Tuple[str, ...]] = {
 
 LETTER_NORMALIZATION_MAP = str.maketrans({"ي": "ی", "ك": "ک"})
 
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NON_DIGIT_PATTERN = re.compile(r"\D")
+INVISIBLE_MARK_PATTERN = re.compile(r"[\u200c\u200f]")
+COMPACT_DATE_PATTERN = re.compile(r"\d{8}")
+DATETIME_PATTERNS = (
+    re.compile(r"(\d{3,4})/(\d{1,2})/(\d{1,2})\s+(\d{1,2}):(\d{1,2})"),  # YYYY/MM/DD HH:MM
+    re.compile(r"(\d{3,4})/(\d{1,2})/(\d{1,2})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})"),  # YYYY/MM/DD HH:MM:SS
+)
+DATE_PATTERN = re.compile(r"(\d{3,4})/(\d{1,2})/(\d{1,2})")
+
 STATUS_TAG_SOURCE: Mapping[str, str] = {
     "ثبت نوبت": "not_showed_patient",
     "چاپ نوبت": "showup_patient",
@@ -167,11 +184,13 @@ CLINIC_TAG_SOURCE: Mapping[str, str] = {
     "کلینیک ویژه فوق تخصصی قلب": "heart_super_specialty_clinic",
 }
 
+CALENDAR_CACHE_SIZE = 8192
+
 JALALI_MONTH_DAYS = (31, 31, 31, 31, 31, 31, 30, 30, 30, 30, 30, 29)
 
 
 def _normalize_header(value: str) -> str:
-    return re.sub(r"\s+", "", str(value)).casefold()
+    return WHITESPACE_PATTERN.sub("", str(value)).casefold()
 
 
 def _select_columns(columns: Iterable[str]) -> Mapping[str, str]:
@@ -214,7 +233,7 @@ def normalize_farsi_text(value: object) -> str:
     if not text:
         return ""
     normalized = text.translate(LETTER_NORMALIZATION_MAP)
-    normalized = re.sub(r"\s+", " ", normalized)
+    normalized = WHITESPACE_PATTERN.sub(" ", normalized)
     return normalized.strip()
 
 
@@ -227,6 +246,92 @@ APPOINTMENT_TYPE_TAG_MAP = _prepare_normalized_mapping(APPOINTMENT_TYPE_TAG_SOUR
 CLINIC_TAG_MAP = _prepare_normalized_mapping(CLINIC_TAG_SOURCE)
 
 
+BASE_TAGS: Tuple[str, ...] = ("noor_hospital_queue", "patient")
+
+# Bit position of every tag in a tag mask (tag i is 1 << i). Stored tag_mask
+# values depend on these positions: append new tags at the end, never reorder
+# or remove entries. Bit 63 is the int64 sign bit, so at most 63 tags fit.
+TAG_REGISTRY: Tuple[str, ...] = (
+    "noor_hospital_queue",
+    "patient",
+    "not_showed_patient",
+    "showup_patient",
+    "canceling_patient",
+    "internet_user",
+    "phone_user",
+    "bariatric_surgery_clinic",
+    "checkup_specialty_clinic",
+    "gastro_hepatology_specialty_clinic",
+    "optometry_clinic",
+    "orthopedics_clinic",
+    "urology_clinic",
+    "internal_medicine_clinic",
+    "pediatric_surgery_clinic",
+    "general_surgery_clinic",
+    "obgyn_surgery_clinic",
+    "vascular_varicose_surgery_clinic",
+    "oral_maxillofacial_surgery_clinic",
+    "cardiac_surgery_clinic",
+    "neurosurgery_clinic",
+    "hematology_oncology_clinic",
+    "internal_specialty_clinic",
+    "pediatric_neonatal_internal_clinic",
+    "pulmonology_clinic",
+    "cardiology_clinic",
+    "pediatric_neurology_clinic",
+    "psychiatry_clinic",
+    "aesthetics_beauty_clinic",
+    "infectious_diseases_clinic",
+    "dermatology_hair_aesthetics_clinic",
+    "ophthalmology_clinic",
+    "ent_clinic",
+    "nutrition_diet_therapy_clinic",
+    "plastic_surgery_clinic",
+    "neurology_clinic",
+    "wound_care_clinic",
+    "audiology_clinic",
+    "sexual_marital_disorders_clinic",
+    "cardiac_super_specialty_clinic",
+    "nephrology_endocrine_diabetes_thyroid_clinic",
+    "breast_super_specialty_clinic",
+    "pediatric_gastroenterology_clinic",
+    "counseling_psychology_clinic",
+    "pain_super_specialty_clinic",
+    "knee_joint_replacement_clinic",
+    "pediatric_cardiology_clinic",
+    "rheumatology_super_specialty_clinic",
+    "heart_super_specialty_clinic",
+)
+
+# Order in which build_tags emits tags; masks are decoded in this order.
+TAG_DISPLAY_ORDER: Tuple[str, ...] = tuple(
+    dict.fromkeys(
+        (
+            *BASE_TAGS,
+            *STATUS_TAG_SOURCE.values(),
+            *APPOINTMENT_TYPE_TAG_SOURCE.values(),
+            *CLINIC_TAG_SOURCE.values(),
+        )
+    )
+)
+
+assert len(TAG_REGISTRY) <= 63, "Tag masks are int64; TAG_REGISTRY cannot hold more than 63 tags"
+assert len(set(TAG_REGISTRY)) == len(TAG_REGISTRY), "TAG_REGISTRY contains a duplicate tag"
+assert set(TAG_DISPLAY_ORDER) <= set(TAG_REGISTRY), (
+    f"Tags without a bit; append them to TAG_REGISTRY: {sorted(set(TAG_DISPLAY_ORDER) - set(TAG_REGISTRY))}"
+)
+
+TAG_BITS: Mapping[str, int] = {tag: 1 << position for position, tag in enumerate(TAG_REGISTRY)}
+BASE_TAG_MASK = sum(TAG_BITS[tag] for tag in BASE_TAGS)
+
+TAG_SOURCE_COLUMNS: Tuple[Tuple[str, Mapping[str, str]], ...] = (
+    ("status_raw", STATUS_TAG_MAP),
+    ("appointment_type_raw", APPOINTMENT_TYPE_TAG_MAP),
+    ("clinic_raw", CLINIC_TAG_MAP),
+)
+
+
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
 def jalali_to_gregorian(j_year: int, j_month: int, j_day: int) -> Tuple[int, int, int]:
     """
     Convert Jalali date to Gregorian using jdatetime library.
@@ -259,23 +364,18 @@ def parse_visit_date(value: object) -> pd.Timestamp:
             return excel_candidate
 
     text = normalize_digits(value)
-    text = re.sub(r"[\u200c\u200f]", "", text)
+    text = INVISIBLE_MARK_PATTERN.sub("", text)
     text = text.replace(".", "/").replace("-", "/").strip()
     if not text:
         return pd.NaT
 
     # Handle 8-digit format (YYYYMMDD)
-    if re.fullmatch(r"\d{8}", text):
+    if COMPACT_DATE_PATTERN.fullmatch(text):
         text = f"{text[:4]}/{text[4:6]}/{text[6:]}"
 
     # Try to parse as datetime with time component first
-    datetime_patterns = [
-        r"(\d{3,4})/(\d{1,2})/(\d{1,2})\s+(\d{1,2}):(\d{1,2})",  # YYYY/MM/DD HH:MM
-        r"(\d{3,4})/(\d{1,2})/(\d{1,2})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})",  # YYYY/MM/DD HH:MM:SS
-    ]
-
-    for pattern in datetime_patterns:
-        match = re.search(pattern, text)
+    for pattern in DATETIME_PATTERNS:
+        match = pattern.search(text)
         if match:
             groups = match.groups()
             year, month, day = int(groups[0]), int(groups[1]), int(groups[2])
@@ -298,7 +398,7 @@ def parse_visit_date(value: object) -> pd.Timestamp:
                     return pd.NaT
 
     # Try to parse as date only (no time)
-    match = re.search(r"(\d{3,4})/(\d{1,2})/(\d{1,2})", text)
+    match = DATE_PATTERN.search(text)
     if not match:
         return pd.NaT
 
@@ -320,6 +420,7 @@ def parse_visit_date(value: object) -> pd.Timestamp:
             return pd.NaT
 
 
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
 def _is_jalali_date(year: int, month: int, day: int) -> bool:
     """
     Determine if a date is likely Jalali using jdatetime library validation.
@@ -424,6 +525,7 @@ def format_visit_date_for_database(value: pd.Timestamp) -> str | pd.NA:
     return ts.isoformat()
 
 
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
 def gregorian_to_jalali(g_year: int, g_month: int, g_day: int) -> Tuple[int, int, int]:
     """
     Convert Gregorian date to Jalali using jdatetime library.
@@ -443,8 +545,8 @@ def build_tags(row: pd.Series) -> str:
         if tag and tag not in tags:
             tags.append(tag)
 
-    add("noor_hospital_queue")
-    add("patient")
+    for tag in BASE_TAGS:
+        add(tag)
 
     status_value = normalize_farsi_text(row.get("status_raw", pd.NA))
     if status_value:
@@ -463,8 +565,73 @@ def build_tags(row: pd.Series) -> str:
     return ",".join(tags) + ","
 
 
+def build_tag_masks(df: pd.DataFrame) -> pd.Series:
+    """
+    Vectorized counterpart of build_tags returning one int64 bitmask per row
+    (bit positions from TAG_REGISTRY). Each distinct raw value is normalized once.
+    """
+    masks = np.full(len(df), BASE_TAG_MASK, dtype=np.int64)
+    for column, tag_map in TAG_SOURCE_COLUMNS:
+        if column not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[column])
+        unique_bits = [TAG_BITS.get(tag_map.get(normalize_farsi_text(value).casefold()), 0) for value in uniques]
+        # Missing values get code -1, which picks the trailing zero.
+        masks |= np.array(unique_bits + [0], dtype=np.int64)[codes]
+    return pd.Series(masks, index=df.index, name="tag_mask")
+
+
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _tag_bit(column: str, value: object) -> int:
+    """Bit of the tag a raw status/appointment type/clinic value maps to (0 if none), for single records."""
+    tag_map = dict(TAG_SOURCE_COLUMNS)[column]
+    return TAG_BITS.get(tag_map.get(normalize_farsi_text(value).casefold()), 0)
+
+
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def tags_from_mask(mask: int) -> str:
+    """Render a tag mask in the comma-separated form produced by build_tags."""
+    tags = [tag for tag in TAG_DISPLAY_ORDER if mask & TAG_BITS[tag]]
+    if not tags:
+        return ""
+    return ",".join(tags) + ","
+
+
+def _tag_mask_for(tags: Iterable[str]) -> int:
+    mask = 0
+    for tag in tags:
+        if tag not in TAG_BITS:
+            raise KeyError(f"Unknown tag {tag!r}; known tags are listed in TAG_REGISTRY.")
+        mask |= TAG_BITS[tag]
+    return mask
+
+
+def filter_by_tag(df: pd.DataFrame, *tags: str, column: str = "tag_mask") -> pd.DataFrame:
+    """Return rows of df whose tag mask has all of the given tags set."""
+    wanted = _tag_mask_for(tags)
+    return df[(df[column].to_numpy(dtype=np.int64) & wanted) == wanted]
+
+
+def count_by_tag(masks: pd.Series) -> pd.Series:
+    """Count rows carrying each registered tag, ordered as TAG_REGISTRY."""
+    values = masks.to_numpy(dtype=np.int64)
+    counts = [int(np.count_nonzero(values & TAG_BITS[tag])) for tag in TAG_REGISTRY]
+    return pd.Series(counts, index=list(TAG_REGISTRY), name="count")
+
+
+def expand_tag_masks(df: pd.DataFrame) -> pd.DataFrame:
+    """Replace a tag_mask column with the string tags column, in place of it."""
+    if "tag_mask" not in df.columns:
+        return df
+    codes, uniques = pd.factorize(df["tag_mask"])
+    rendered = np.array([tags_from_mask(int(mask)) for mask in uniques] + [""], dtype=object)
+    expanded = df.copy()
+    expanded["tag_mask"] = rendered[codes]
+    return expanded.rename(columns={"tag_mask": "tags"})
+
+
 def clean_national_id(value: object) -> str | pd.NA:
-    digits = re.sub(r"\D", "", normalize_digits(value))
+    digits = NON_DIGIT_PATTERN.sub("", normalize_digits(value))
     if len(digits) < 8 or len(digits) > 11:
         return pd.NA
     if len(set(digits)) == 1:
@@ -482,7 +649,7 @@ def clean_national_id(value: object) -> str | pd.NA:
 
 
 def clean_mobile(value: object) -> str | pd.NA:
-    digits = re.sub(r"\D", "", normalize_digits(value))
+    digits = NON_DIGIT_PATTERN.sub("", normalize_digits(value))
     if not digits:
         return pd.NA
 
@@ -514,7 +681,7 @@ def split_full_name(value: object) -> Tuple[str | pd.NA, str | pd.NA]:
     text = str(value).strip()
     if not text or text.casefold() in {"nan", "none"}:
         return pd.NA, pd.NA
-    pieces = [part for part in re.split(r"\s+", text) if part]
+    pieces = [part for part in WHITESPACE_PATTERN.split(text) if part]
     if not pieces:
         return pd.NA, pd.NA
     if len(pieces) == 1:
@@ -524,6 +691,9 @@ def split_full_name(value: object) -> Tuple[str | pd.NA, str | pd.NA]:
     return first, last
 
 
+HONORIFIC_PATTERN = re.compile(r'^(آقای|خانم|دکتر|مهندس|استاد|جناب|سرکار|سرکار خانم|آقا|خانم)\s*')
+
+
 def detect_gender(first_name: object) -> str | pd.NA:
     """
     Detect gender based on Persian first name using local database lookup.
@@ -550,7 +720,7 @@ def detect_gender(first_name: object) -> str | pd.NA:
 
     # Try with common Persian name patterns
     # Remove common prefixes/suffixes and try again
-    cleaned_name = re.sub(r'^(آقای|خانم|دکتر|مهندس|استاد|جناب|سرکار|سرکار خانم|آقا|خانم)\s*', '', name)
+    cleaned_name = HONORIFIC_PATTERN.sub('', name)
     if cleaned_name != name:
         gender = PERSIAN_GENDER_LOOKUP.get(cleaned_name)
         if gender:
@@ -559,6 +729,232 @@ def detect_gender(first_name: object) -> str | pd.NA:
     return pd.NA
 
 
+NORMALIZER_CACHE_SIZE = 200_000
+
+
+def _factorize_exact(series: pd.Series) -> tuple[np.ndarray, list]:
+    """
+    pd.factorize that keeps equal values of different types apart. factorize
+    treats 1, 1.0 and True as one value, so a mixed object column is factorized
+    one type at a time. Missing values get code -1.
+    """
+    if series.dtype != object or not pd.api.types.infer_dtype(series, skipna=True).startswith("mixed"):
+        codes, uniques = pd.factorize(series)
+        return codes, list(uniques)
+    type_codes, types = pd.factorize(series.map(type))
+    codes = np.full(len(series), -1, dtype=np.intp)
+    uniques: list = []
+    for type_code in range(len(types)):
+        mask = type_codes == type_code
+        sub_codes, sub_uniques = pd.factorize(series[mask])
+        codes[mask] = np.where(sub_codes == -1, -1, sub_codes + len(uniques))
+        uniques.extend(sub_uniques)
+    return codes, uniques
+
+
+class NormalizerCache:
+    """
+    Bounded LRU of results for one per-cell normalizer. Kept at module level so
+    results carry over between clean_dataframe calls in the same process.
+    """
+
+    def __init__(self, func: Callable[[object], object], maxsize: int = NORMALIZER_CACHE_SIZE) -> None:
+        self.func = func
+        self.maxsize = maxsize
+        self._results: OrderedDict[tuple, object] = OrderedDict()
+        self.rows = 0
+        self.unique = 0
+        self.hits = 0
+
+    def lookup(self, value: object) -> object:
+        # Keyed on type too, so 1, 1.0 and True are not conflated.
+        key = (type(value), value)
+        try:
+            result = self._results[key]
+        except KeyError:
+            result = self.func(value)
+            self._results[key] = result
+            if len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        else:
+            self._results.move_to_end(key)
+            self.hits += 1
+        return result
+
+    def map(self, series: pd.Series) -> np.ndarray:
+        """Evaluate func once per distinct value of series and broadcast back by codes."""
+        codes, uniques = _factorize_exact(series)
+        results = [self.lookup(value) for value in uniques]
+        if (codes == -1).any():
+            # Missing values get code -1, which picks the trailing entry.
+            results.append(self.func(pd.NA))
+        self.rows += len(series)
+        self.unique += len(uniques)
+        mapped = np.empty(len(results), dtype=object)
+        mapped[:] = results
+        return mapped[codes]
+
+    def log_stats(self) -> None:
+        if not self.rows:
+            return
+        computed = self.unique - self.hits
+        LOGGER.info(
+            "%s: %d rows, %d unique values, %d cached, %d computed (%.1f%% of rows reused)",
+            self.func.__name__, self.rows, self.unique, self.hits, computed,
+            (self.rows - computed) / self.rows * 100,
+        )
+        self.rows = self.unique = self.hits = 0
+
+
+NORMALIZER_CACHES: dict[Callable[[object], object], NormalizerCache] = {
+    func: NormalizerCache(func)
+    for func in (clean_national_id, clean_mobile, split_full_name, detect_gender, parse_visit_date)
+}
+
+
+def _log_normalizer_stats() -> None:
+    """Log and reset the per-normalizer hit rates of the last cleaning run."""
+    for cache in NORMALIZER_CACHES.values():
+        cache.log_stats()
+
+
+def map_unique(series: pd.Series, func: Callable[[object], object]) -> pd.Series:
+    """
+    series.apply(func) computed once per distinct value through the LRU of func.
+    Each function object gets its own cache, so pass module-level functions
+    rather than a new lambda per call.
+    """
+    cache = NORMALIZER_CACHES.get(func)
+    if cache is None:
+        cache = NORMALIZER_CACHES[func] = NormalizerCache(func)
+    return pd.Series(list(cache.map(series)), index=series.index, name=series.name)
+
+
+PHONE_USER_PLACEHOLDER = "کاربر تلفنی"
+NAME_PUNCTUATION_PATTERN = re.compile(r"[.\-]")
+NAME_LATIN_PATTERN = re.compile(r"[A-Za-z]", re.IGNORECASE)
+NAME_NUMERIC_PATTERN = re.compile(r"\d+$")
+
+# Exclusion reason codes, in the order the rules are checked
+NAME_EXCLUSION_REASONS: Tuple[str, ...] = (
+    "phone_user_placeholder",
+    "punctuation",
+    "latin_letters",
+    "first_name_too_short",
+    "last_name_too_short",
+    "first_name_numeric",
+    "last_name_numeric",
+)
+
+
+def name_exclusion_reason(full_name: object, first_name: object, last_name: object) -> str:
+    """Return the first name rule the record breaks (see NAME_EXCLUSION_REASONS), or "" if it passes."""
+    full = "" if full_name is None or pd.isna(full_name) else str(full_name)
+    first = "" if first_name is None or pd.isna(first_name) else str(first_name)
+    last = "" if last_name is None or pd.isna(last_name) else str(last_name)
+
+    if PHONE_USER_PLACEHOLDER in full.casefold():
+        return "phone_user_placeholder"
+    if NAME_PUNCTUATION_PATTERN.search(full):
+        return "punctuation"
+    if NAME_LATIN_PATTERN.search(full):
+        return "latin_letters"
+    if len(first) < 3:
+        return "first_name_too_short"
+    if len(last) < 3:
+        return "last_name_too_short"
+    if NAME_NUMERIC_PATTERN.match(first):
+        return "first_name_numeric"
+    if NAME_NUMERIC_PATTERN.match(last):
+        return "last_name_numeric"
+    return ""
+
+
+def name_exclusion_reasons(df: pd.DataFrame) -> pd.Series:
+    """
+    name_exclusion_reason for every row of df in one pass over full_name,
+    first_name and last_name, evaluated once per distinct combination.
+    """
+    codes = []
+    uniques = []
+    for column in ("full_name", "first_name", "last_name"):
+        column_codes, column_uniques = pd.factorize(df[column])
+        codes.append(column_codes)
+        # Missing values get code -1, which picks the trailing None.
+        uniques.append(list(column_uniques) + [None])
+    if not len(df):
+        return pd.Series("", index=df.index, dtype=object, name="exclusion_reason")
+
+    combinations, inverse = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    reasons = np.array(
+        [
+            name_exclusion_reason(uniques[0][full], uniques[1][first], uniques[2][last])
+            for full, first, last in combinations
+        ],
+        dtype=object,
+    )
+    return pd.Series(reasons[inverse.ravel()], index=df.index, name="exclusion_reason")
+
+
+# Record keys accepted by clean_record: target names and source headers, as given and normalized
+RECORD_FIELDS: Mapping[str, str] = {
+    key: target
+    for target, aliases in (*COLUMN_ALIASES.items(), *OPTIONAL_COLUMN_ALIASES.items())
+    for alias in (target, *aliases)
+    for key in (alias, _normalize_header(alias))
+}
+
+
+def _none_if_missing(value: object) -> object:
+    return None if value is None or value is pd.NA or value is pd.NaT else value
+
+
+def clean_record(record: Mapping[str, object]) -> dict[str, object]:
+    """
+    Clean one appointment record without building a DataFrame, for real-time intake.
+
+    Keys may be the output names (national_id, full_name, mobile, visit_date,
+    status, appointment_type, clinic) or the export's Farsi headers. Returns the
+    cleaned output columns with None for missing values, plus exclusion_reason:
+    "" for a usable record, "invalid_national_id", or a NAME_EXCLUSION_REASONS code.
+    Deduplication and duplicate-phone checks need other rows and are not applied.
+    """
+    fields: dict[str, object] = {}
+    for key, value in record.items():
+        target = RECORD_FIELDS.get(key) or RECORD_FIELDS.get(_normalize_header(key))
+        if target is not None and target not in fields:
+            fields[target] = value
+
+    full_name = fields.get("full_name")
+    national_id = _none_if_missing(clean_national_id(fields.get("national_id")))
+    first_name, last_name = split_full_name(full_name)
+    first_name = _none_if_missing(first_name)
+    last_name = _none_if_missing(last_name)
+    visit = parse_visit_date(fields.get("visit_date"))
+
+    exclusion_reason = "invalid_national_id" if national_id is None else ""
+    exclusion_reason = exclusion_reason or name_exclusion_reason(full_name, first_name, last_name)
+
+    return {
+        "national_id": national_id,
+        "first_name": first_name,
+        "last_name": last_name,
+        "gender": _none_if_missing(detect_gender(first_name)),
+        "mobile": _none_if_missing(clean_mobile(fields.get("mobile"))),
+        "visit_date": _none_if_missing(format_visit_date(visit)),
+        "visit_date_ui": _none_if_missing(format_visit_date_for_ui(visit)),
+        "visit_datetime_ui": _none_if_missing(format_visit_datetime_for_ui(visit)),
+        "visit_date_db": _none_if_missing(format_visit_date_for_database(visit)),
+        "tags": tags_from_mask(
+            BASE_TAG_MASK
+            | _tag_bit("status_raw", fields.get("status"))
+            | _tag_bit("appointment_type_raw", fields.get("appointment_type"))
+            | _tag_bit("clinic_raw", fields.get("clinic"))
+        ),
+        "exclusion_reason": exclusion_reason,
+    }
+
+
 def _is_name_complete(first_name: str, last_name: str) -> bool:
     """Check if name is complete (both first and last name have at least 3 characters)."""
     if pd.isna(first_name) or pd.isna(last_name):
@@ -574,20 +970,27 @@ def _enhanced_deduplication(df: pd.DataFrame) -> pd.DataFrame:
     1. Keeps most recent record per national_id
     2. If most recent record has incomplete name, looks for earlier records with complete name
     3. Returns records with incomplete names that couldn't be completed
+
+    Rows flagged in a name_history column only serve as name sources and are
+    never returned themselves.
     """
     result_records = []
     incomplete_records = []
+    has_history = "name_history" in df.columns
 
     # Group by national_id
     for national_id, group in df.groupby("national_id"):
         if pd.isna(national_id):
             continue
 
-        # Sort group by visit_date_parsed (most recent first)
-        group = group.sort_values("visit_date_parsed", ascending=False, na_position="last")
+        # Sort group by visit_date_parsed (most recent first); stable, so ties keep input order
+        group = group.sort_values("visit_date_parsed", ascending=False, na_position="last", kind="stable")
 
         # Get the most recent record
-        most_recent = group.iloc[0]
+        candidates = group[~group["name_history"]] if has_history else group
+        if candidates.empty:
+            continue
+        most_recent = candidates.iloc[0]
 
         # Check if most recent record has complete name
         if _is_name_complete(most_recent["first_name"], most_recent["last_name"]):
@@ -630,14 +1033,51 @@ def _enhanced_deduplication(df: pd.DataFrame) -> pd.DataFrame:
     return result_df
 
 
-def clean_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+OUTPUT_COLUMNS: Tuple[str, ...] = (
+    "national_id", "first_name", "last_name", "gender", "mobile",
+    "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags",
+)
+
+# Derived output columns and how to compute them; only the requested ones are built
+VISIT_DATE_FORMATTERS: Mapping[str, Callable[[object], object]] = {
+    "visit_date": format_visit_date,  # Database storage (Gregorian)
+    "visit_date_ui": format_visit_date_for_ui,  # UI display (Jalali)
+    "visit_datetime_ui": format_visit_datetime_for_ui,  # UI display with time
+    "visit_date_db": format_visit_date_for_database,  # Database ISO format
+}
+
+
+def _output_columns(tag_format: str, columns: Iterable[str] | None = None) -> list[str]:
     """
-    Enhanced cleaning function that returns 4 dataframes:
-    1. cleaned_output: Valid records with complete names
-    2. excluded_output: Records with invalid/incomplete names
-    3. duplicate_phone_output: Records with duplicate phone numbers
-    4. incomplete_name_output: Records where name couldn't be completed from earlier records
+    Resolve the requested output columns (all of OUTPUT_COLUMNS by default), in the
+    order given. "tags" and "tag_mask" both mean the tags column of tag_format.
     """
+    if tag_format not in {"string", "mask"}:
+        raise ValueError(f"Unsupported tag format {tag_format!r}. Use 'string' or 'mask'.")
+    tags_column = "tags" if tag_format == "string" else "tag_mask"
+    resolved = []
+    for column in OUTPUT_COLUMNS if columns is None else columns:
+        if column in {"tags", "tag_mask"}:
+            column = tags_column
+        elif column not in OUTPUT_COLUMNS:
+            raise ValueError(f"Unknown output column {column!r}. Choose from {OUTPUT_COLUMNS}.")
+        resolved.append(column)
+    if not resolved:
+        raise ValueError("At least one output column is required.")
+    return list(dict.fromkeys(resolved))
+
+
+def _add_output_columns(frame: pd.DataFrame, output_columns: list[str], tag_format: str) -> None:
+    """Build the requested visit date formats and tags from visit_date_parsed and the raw tag sources."""
+    for column, formatter in VISIT_DATE_FORMATTERS.items():
+        if column in output_columns:
+            frame[column] = map_unique(frame["visit_date_parsed"], formatter)
+    if "tags" in output_columns or "tag_mask" in output_columns:
+        _add_tags(frame, tag_format)
+
+
+def _select_input_subset(df: pd.DataFrame) -> pd.DataFrame:
+    """Pick the source columns and rename them to national_id_raw, full_name, mobile_raw, ..."""
     selectors = _select_columns(df.columns)
     optional_selectors = _select_optional_columns(df.columns)
 
@@ -673,19 +1113,62 @@ def clean_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.Da
         if column not in subset.columns:
             subset[column] = pd.NA
 
-    subset["national_id"] = subset["national_id_raw"].apply(clean_national_id)
-    subset["mobile"] = subset["mobile_raw"].apply(clean_mobile)
+    return subset
 
-    name_parts = subset["full_name"].apply(
-        lambda val: pd.Series(split_full_name(val), index=["first_name", "last_name"])
-    )
-    subset = subset.join(name_parts)
 
-    # Add gender detection
-    subset["gender"] = subset["first_name"].apply(detect_gender)
+def _add_tags(frame: pd.DataFrame, tag_format: str) -> None:
+    if tag_format == "mask":
+        frame["tag_mask"] = build_tag_masks(frame)
+    else:
+        # Same output as build_tags per row, with each raw value normalized once
+        frame["tags"] = expand_tag_masks(build_tag_masks(frame).to_frame())["tags"]
+
+
+def clean_dataframe(
+    df: pd.DataFrame,
+    tag_format: str = "string",
+    name_history: pd.DataFrame | None = None,
+    columns: Iterable[str] | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Enhanced cleaning function that returns 4 dataframes:
+    1. cleaned_output: Valid records with complete names
+    2. excluded_output: Records with invalid/incomplete names
+    3. duplicate_phone_output: Records with duplicate phone numbers
+    4. incomplete_name_output: Records where name couldn't be completed from earlier records
+
+    With tag_format="mask" the frames carry an int64 tag_mask column instead of
+    the tags string; export_dataframe renders it back to the string form.
+
+    name_history (see DateWindow.history_frame) holds rows outside a date window
+    that are only used to complete names during deduplication.
+
+    columns selects the output columns (default: all of OUTPUT_COLUMNS); derived
+    columns that are not selected, such as gender or the Jalali formats, are not
+    computed. The excluded frame always adds full_name and exclusion_reason.
+    """
+    output_columns = _output_columns(tag_format, columns)
+
+    subset = _select_input_subset(df)
+
+    subset["national_id"] = map_unique(subset["national_id_raw"], clean_national_id)
+    subset["mobile"] = map_unique(subset["mobile_raw"], clean_mobile)
+
+    name_parts = map_unique(subset["full_name"], split_full_name)
+    subset["first_name"] = [parts[0] for parts in name_parts]
+    subset["last_name"] = [parts[1] for parts in name_parts]
+
+    # Add gender detection (from the row's own first name, before name completion)
+    if "gender" in output_columns:
+        subset["gender"] = map_unique(subset["first_name"], detect_gender)
 
     # Parse visit dates BEFORE filtering (needed for deduplication across all records)
-    subset["visit_date_parsed"] = subset["visit_date_raw"].apply(parse_visit_date)
+    subset["visit_date_parsed"] = map_unique(subset["visit_date_raw"], parse_visit_date)
+
+    if name_history is not None and not name_history.empty:
+        subset["name_history"] = False
+        subset = pd.concat([subset, name_history.assign(name_history=True)], ignore_index=True)
+        LOGGER.info("Added %d out-of-window rows for name completion", len(name_history))
 
     # Sort by national_id and visit_date_parsed to prioritize most recent records
     subset = subset.sort_values(
@@ -696,28 +1179,13 @@ def clean_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.Da
     subset = _enhanced_deduplication(subset)
 
     # Now apply name validation filters
-    full_names = subset["full_name"].fillna("").astype(str)
-    contains_karbar = full_names.str.contains("کاربر تلفنی", case=False, regex=False)
-    contains_punctuation = full_names.str.contains(r"[.\-]", regex=True)
-    contains_english = full_names.str.contains(r"[A-Za-z]", case=False, regex=True)
-
-    # Check if first_name or last_name is less than 3 characters (enhanced requirement)
-    first_name_too_short = subset["first_name"].fillna("").astype(str).str.len() < 3
-    last_name_too_short = subset["last_name"].fillna("").astype(str).str.len() < 3
-
-    # Check if first_name or last_name contains only digits
-    first_name_numeric = subset["first_name"].fillna("").astype(str).str.match(r"^\d+$")
-    last_name_numeric = subset["last_name"].fillna("").astype(str).str.match(r"^\d+$")
-
-    invalid_name_mask = (
-        contains_karbar | contains_punctuation | contains_english |
-        first_name_too_short | last_name_too_short |
-        first_name_numeric | last_name_numeric
-    )
+    subset["exclusion_reason"] = name_exclusion_reasons(subset)
+    invalid_name_mask = subset["exclusion_reason"] != ""
 
     excluded = subset[invalid_name_mask].copy()
     if not excluded.empty:
         LOGGER.info("Moved %d rows with invalid names to excluded set", len(excluded))
+        LOGGER.debug("Exclusion reasons: %s", excluded["exclusion_reason"].value_counts().to_dict())
 
     subset = subset[~invalid_name_mask].copy()
 
@@ -734,77 +1202,684 @@ def clean_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.Da
         # Remove duplicates from main dataset
         subset = subset.drop(phone_duplicates.index)
 
-    # Format dates for different purposes
-    subset["visit_date"] = subset["visit_date_parsed"].apply(format_visit_date)  # Database storage (Gregorian)
-    subset["visit_date_ui"] = subset["visit_date_parsed"].apply(format_visit_date_for_ui)  # UI display (Jalali)
-    subset["visit_datetime_ui"] = subset["visit_date_parsed"].apply(format_visit_datetime_for_ui)  # UI display with time
-    subset["visit_date_db"] = subset["visit_date_parsed"].apply(format_visit_date_for_database)  # Database ISO format
-    subset["tags"] = subset.apply(build_tags, axis=1)
+    # Format dates for different purposes and build tags
+    _add_output_columns(subset, output_columns, tag_format)
 
-    cleaned_output = subset[["national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"]].copy()
+    cleaned_output = subset[output_columns].copy()
 
     # Process excluded records
-    if not excluded.empty:
-        excluded["visit_date_parsed"] = excluded["visit_date_raw"].apply(parse_visit_date)
-        excluded["visit_date"] = excluded["visit_date_parsed"].apply(format_visit_date)
-        excluded["visit_date_ui"] = excluded["visit_date_parsed"].apply(format_visit_date_for_ui)
-        excluded["visit_datetime_ui"] = excluded["visit_date_parsed"].apply(format_visit_datetime_for_ui)
-        excluded["visit_date_db"] = excluded["visit_date_parsed"].apply(format_visit_date_for_database)
-        excluded["tags"] = excluded.apply(build_tags, axis=1)
-    else:
-        excluded["visit_date"] = pd.NA
-        excluded["visit_date_ui"] = pd.NA
-        excluded["visit_datetime_ui"] = pd.NA
-        excluded["visit_date_db"] = pd.NA
-        excluded["tags"] = ""
+    _add_output_columns(excluded, output_columns, tag_format)
 
     excluded_output = excluded[
-        ["full_name", "national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"]
+        ["full_name", *output_columns, "exclusion_reason"]
     ].copy()
 
     # Process duplicate phone records
     if not phone_duplicates.empty:
-        phone_duplicates["visit_date"] = phone_duplicates["visit_date_parsed"].apply(format_visit_date)
-        phone_duplicates["visit_date_ui"] = phone_duplicates["visit_date_parsed"].apply(format_visit_date_for_ui)
-        phone_duplicates["visit_datetime_ui"] = phone_duplicates["visit_date_parsed"].apply(format_visit_datetime_for_ui)
-        phone_duplicates["visit_date_db"] = phone_duplicates["visit_date_parsed"].apply(format_visit_date_for_database)
-        phone_duplicates["tags"] = phone_duplicates.apply(build_tags, axis=1)
+        _add_output_columns(phone_duplicates, output_columns, tag_format)
     else:
-        phone_duplicates = pd.DataFrame(columns=["national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"])
+        phone_duplicates = pd.DataFrame(columns=output_columns)
 
-    duplicate_phone_output = phone_duplicates[
-        ["national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"]
-    ].copy()
+    duplicate_phone_output = phone_duplicates[output_columns].copy()
 
     # Process incomplete name records from enhanced deduplication
     if hasattr(_enhanced_deduplication, 'incomplete_records') and not _enhanced_deduplication.incomplete_records.empty:
         incomplete_records = _enhanced_deduplication.incomplete_records.copy()
-        incomplete_records["visit_date"] = incomplete_records["visit_date_parsed"].apply(format_visit_date)
-        incomplete_records["visit_date_ui"] = incomplete_records["visit_date_parsed"].apply(format_visit_date_for_ui)
-        incomplete_records["visit_datetime_ui"] = incomplete_records["visit_date_parsed"].apply(format_visit_datetime_for_ui)
-        incomplete_records["visit_date_db"] = incomplete_records["visit_date_parsed"].apply(format_visit_date_for_database)
-        incomplete_records["tags"] = incomplete_records.apply(build_tags, axis=1)
-        incomplete_name_output = incomplete_records[
-            ["national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"]
-        ].copy()
+        _add_output_columns(incomplete_records, output_columns, tag_format)
+        incomplete_name_output = incomplete_records[output_columns].copy()
         LOGGER.info("Found %d records with incomplete names that couldn't be completed", len(incomplete_name_output))
     else:
-        incomplete_name_output = pd.DataFrame(columns=["national_id", "first_name", "last_name", "gender", "mobile", "visit_date", "visit_date_ui", "visit_datetime_ui", "visit_date_db", "tags"])
+        incomplete_name_output = pd.DataFrame(columns=output_columns)
+
+    _log_normalizer_stats()
 
     return cleaned_output, excluded_output, duplicate_phone_output, incomplete_name_output
 
 
-def merge_dataframes(input_files: list[Path]) -> pd.DataFrame:
-    """Read and merge multiple Excel files into a single DataFrame."""
+# Python's \s for str also matches Unicode spaces, \v, \x1c-\x1f and \x85;
+# RE2 (used by DuckDB) only matches ASCII whitespace for \s.
+SQL_WHITESPACE = r"[\s\p{Z}\x{0b}\x{1c}-\x{1f}\x{85}]"
+
+SQL_HONORIFIC_PATTERN = HONORIFIC_PATTERN.pattern.replace(r"\s", SQL_WHITESPACE)
+
+# Column types of the frames handed to DuckDB. Types inferred from a frame are
+# unreliable (an all-missing optional column comes out as INTEGER), so every
+# frame is exposed through a view that casts to these.
+DUCKDB_INPUT_SCHEMAS: Mapping[str, Mapping[str, str]] = {
+    "raw_rows": {
+        "row_id": "BIGINT",
+        "national_id_raw": "VARCHAR",
+        "full_name": "VARCHAR",
+        "mobile_raw": "VARCHAR",
+        "visit_date_parsed": "TIMESTAMP",
+        "status_raw": "VARCHAR",
+        "appointment_type_raw": "VARCHAR",
+        "clinic_raw": "VARCHAR",
+    },
+    "history_rows": {
+        "row_id": "BIGINT",
+        "national_id": "VARCHAR",
+        "first_name": "VARCHAR",
+        "last_name": "VARCHAR",
+        "visit_date_parsed": "TIMESTAMP",
+    },
+    "date_formats": {
+        "visit_date_parsed": "TIMESTAMP",
+        "visit_date": "VARCHAR",
+        "visit_date_ui": "VARCHAR",
+        "visit_datetime_ui": "VARCHAR",
+        "visit_date_db": "VARCHAR",
+    },
+    "tag_sources": {"source": "VARCHAR", "key": "VARCHAR", "bit": "BIGINT"},
+    "tag_registry": {"position": "BIGINT", "tag": "VARCHAR", "bit": "BIGINT"},
+    "gender_lookup": {"name": "VARCHAR", "gender": "VARCHAR"},
+}
+
+DUCKDB_MACROS = f"""
+CREATE OR REPLACE TEMP MACRO norm_digits(x) AS
+    CASE
+        WHEN x IS NULL OR lower(trim(regexp_replace(x, '{SQL_WHITESPACE}+', ' ', 'g'))) IN ('', 'nan', 'none') THEN ''
+        ELSE translate(x, '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+    END;
+CREATE OR REPLACE TEMP MACRO norm_text(x) AS
+    trim(regexp_replace(translate(norm_digits(x), 'يك', 'یک'), '{SQL_WHITESPACE}+', ' ', 'g'));
+CREATE OR REPLACE TEMP MACRO only_digits(x) AS
+    regexp_replace(norm_digits(x), '\\P{{Nd}}', '', 'g');
+CREATE OR REPLACE TEMP MACRO collapsed_name(x) AS
+    CASE
+        WHEN x IS NULL THEN NULL
+        WHEN lower(trim(regexp_replace(x, '{SQL_WHITESPACE}+', ' ', 'g'))) IN ('', 'nan', 'none') THEN NULL
+        ELSE trim(regexp_replace(x, '{SQL_WHITESPACE}+', ' ', 'g'))
+    END;
+CREATE OR REPLACE TEMP MACRO name_complete(first, last) AS
+    coalesce(length(first) >= 3 AND length(last) >= 3, false);
+"""
+
+DUCKDB_CLEAN_QUERY = f"""
+CREATE OR REPLACE TEMP TABLE normalized AS
+WITH digits AS (
+    SELECT
+        *,
+        only_digits(national_id_raw) AS id_digits,
+        only_digits(mobile_raw) AS mobile_digits,
+        string_split(collapsed_name(full_name), ' ') AS name_parts
+    FROM raw_rows
+),
+mobiles AS (
+    SELECT
+        *,
+        CASE
+            WHEN mobile_digits LIKE '98%' AND length(mobile_digits) = 12 THEN '0' || mobile_digits[3:]
+            WHEN mobile_digits LIKE '0098%' AND length(mobile_digits) = 14 THEN '0' || mobile_digits[5:]
+            ELSE mobile_digits
+        END AS mobile_local
+    FROM digits
+),
+names AS (
+    SELECT
+        *,
+        CASE
+            WHEN len(name_parts) = 1 THEN name_parts[1]
+            ELSE array_to_string(name_parts[1:len(name_parts) - 1], ' ')
+        END AS split_first_name,
+        CASE WHEN len(name_parts) > 1 THEN name_parts[len(name_parts)] END AS split_last_name
+    FROM mobiles
+)
+SELECT
+    row_id,
+    false AS name_history,
+    full_name,
+    CASE
+        WHEN length(id_digits) BETWEEN 8 AND 11 AND id_digits <> repeat(id_digits[1], length(id_digits))
+        THEN id_digits
+    END AS national_id,
+    CASE
+        WHEN length(mobile_local) = 10 AND mobile_local NOT LIKE '0%' THEN '0' || mobile_local
+        WHEN length(mobile_local) IN (10, 11) THEN mobile_local
+    END AS mobile,
+    split_first_name AS first_name,
+    split_last_name AS last_name,
+    visit_date_parsed,
+    status_raw,
+    appointment_type_raw,
+    clinic_raw
+FROM names;
+
+-- detect_gender: whole name, then first word, then without an honorific
+CREATE OR REPLACE TEMP TABLE normalized AS
+SELECT
+    n.* EXCLUDE (gender_key),
+    coalesce(by_name.gender, by_first_word.gender, by_stripped.gender) AS gender
+FROM (SELECT *, norm_text(first_name) AS gender_key FROM normalized) AS n
+LEFT JOIN gender_lookup AS by_name ON by_name.name = n.gender_key
+LEFT JOIN gender_lookup AS by_first_word ON by_first_word.name = split_part(n.gender_key, ' ', 1)
+LEFT JOIN gender_lookup AS by_stripped
+    ON by_stripped.name = regexp_replace(n.gender_key, '{SQL_HONORIFIC_PATTERN}', '');
+
+INSERT INTO normalized (row_id, name_history, national_id, first_name, last_name, visit_date_parsed)
+SELECT row_id, true, national_id, first_name, last_name, visit_date_parsed FROM history_rows;
+
+CREATE OR REPLACE TEMP TABLE deduplicated AS
+WITH latest AS (
+    SELECT * EXCLUDE (recency)
+    FROM (
+        SELECT
+            *,
+            row_number() OVER (
+                PARTITION BY national_id ORDER BY visit_date_parsed DESC NULLS LAST, row_id
+            ) AS recency
+        FROM normalized
+        WHERE national_id IS NOT NULL AND NOT name_history
+    )
+    WHERE recency = 1
+),
+donors AS (
+    SELECT national_id, first_name, last_name
+    FROM (
+        SELECT
+            *,
+            row_number() OVER (
+                PARTITION BY national_id ORDER BY visit_date_parsed DESC NULLS LAST, row_id
+            ) AS recency
+        FROM normalized
+        WHERE national_id IS NOT NULL AND name_complete(first_name, last_name)
+    )
+    WHERE recency = 1
+)
+SELECT
+    latest.* REPLACE (
+        CASE
+            WHEN name_complete(latest.first_name, latest.last_name) THEN latest.first_name
+            ELSE coalesce(donors.first_name, latest.first_name)
+        END AS first_name,
+        CASE
+            WHEN name_complete(latest.first_name, latest.last_name) THEN latest.last_name
+            ELSE coalesce(donors.last_name, latest.last_name)
+        END AS last_name,
+        CASE
+            WHEN name_complete(latest.first_name, latest.last_name) OR donors.national_id IS NULL THEN latest.full_name
+            ELSE donors.first_name || ' ' || donors.last_name
+        END AS full_name
+    ),
+    donors.national_id IS NOT NULL AS name_resolved
+FROM latest
+LEFT JOIN donors USING (national_id);
+
+CREATE OR REPLACE TEMP TABLE dispositions AS
+WITH validated AS (
+    SELECT
+        *,
+        CASE
+            WHEN NOT name_resolved THEN NULL
+            WHEN strpos(lower(coalesce(full_name, '')), '{PHONE_USER_PLACEHOLDER}') > 0 THEN 'phone_user_placeholder'
+            WHEN regexp_matches(coalesce(full_name, ''), '[.\\-]') THEN 'punctuation'
+            WHEN regexp_matches(coalesce(full_name, ''), '(?i)[A-Za-z]') THEN 'latin_letters'
+            WHEN length(coalesce(first_name, '')) < 3 THEN 'first_name_too_short'
+            WHEN length(coalesce(last_name, '')) < 3 THEN 'last_name_too_short'
+            WHEN regexp_matches(coalesce(first_name, ''), '^\\p{{Nd}}+$') THEN 'first_name_numeric'
+            WHEN regexp_matches(coalesce(last_name, ''), '^\\p{{Nd}}+$') THEN 'last_name_numeric'
+        END AS exclusion_reason
+    FROM deduplicated
+),
+phones AS (
+    SELECT
+        *,
+        exclusion_reason IS NULL AND name_resolved AND first_name IS NOT NULL AND last_name IS NOT NULL AS valid
+    FROM validated
+)
+SELECT
+    *,
+    valid AND mobile IS NOT NULL AND count(*) FILTER (WHERE valid) OVER (PARTITION BY mobile) > 1 AS duplicate_phone
+FROM phones;
+
+CREATE OR REPLACE TEMP TABLE tagged AS
+SELECT
+    d.*,
+    {BASE_TAG_MASK}::BIGINT
+        | coalesce(status_tags.bit, 0)
+        | coalesce(appointment_type_tags.bit, 0)
+        | coalesce(clinic_tags.bit, 0) AS tag_mask,
+    f.visit_date,
+    f.visit_date_ui,
+    f.visit_datetime_ui,
+    f.visit_date_db
+FROM dispositions AS d
+LEFT JOIN tag_sources AS status_tags
+    ON status_tags.source = 'status' AND status_tags.key = lower(norm_text(d.status_raw))
+LEFT JOIN tag_sources AS appointment_type_tags
+    ON appointment_type_tags.source = 'appointment_type' AND appointment_type_tags.key = lower(norm_text(d.appointment_type_raw))
+LEFT JOIN tag_sources AS clinic_tags
+    ON clinic_tags.source = 'clinic' AND clinic_tags.key = lower(norm_text(d.clinic_raw))
+LEFT JOIN date_formats AS f USING (visit_date_parsed);
+
+CREATE OR REPLACE TEMP TABLE outputs AS
+SELECT
+    t.*,
+    CASE
+        WHEN NOT name_resolved THEN 'incomplete_name'
+        WHEN exclusion_reason IS NOT NULL THEN 'excluded'
+        WHEN duplicate_phone THEN 'duplicate_phone'
+        WHEN valid THEN 'cleaned'
+    END AS disposition,
+    (
+        SELECT string_agg(r.tag, ',' ORDER BY r.position) || ','
+        FROM tag_registry AS r
+        WHERE (t.tag_mask & r.bit) <> 0
+    ) AS tags
+FROM tagged AS t;
+"""
+
+
+def _as_sql_text(series: pd.Series) -> list[str | None]:
+    """str() of each value (as the pandas path sees it), None for missing; computed per distinct value."""
+    codes, uniques = _factorize_exact(series)
+    texts = [str(value) for value in uniques] + [None]
+    return [texts[code] for code in codes]
+
+
+def _as_sql_timestamps(series: pd.Series) -> np.ndarray:
+    """
+    Parsed visit dates as datetime64[us]. parse_visit_date can return an object
+    column (e.g. NaT mixed with Timestamps outside the nanosecond range), which
+    to_numpy cannot convert directly.
+    """
+    return series.astype("datetime64[us]").to_numpy()
+
+
+def clean_dataframe_duckdb(
+    df: pd.DataFrame,
+    tag_format: str = "string",
+    name_history: pd.DataFrame | None = None,
+    config: Mapping[str, object] | None = None,
+    columns: Iterable[str] | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    clean_dataframe on an embedded DuckDB database instead of pandas object columns.
+
+    ID and mobile cleaning, name splitting, gender lookup, deduplication with name
+    completion (window functions), name validation, duplicate-phone detection and
+    tag building run as SQL and use all cores. Visit dates are parsed and formatted
+    once per distinct value in Python (Jalali conversion needs jdatetime) and joined
+    in. config is passed to duckdb.connect, e.g. {"memory_limit": "4GB",
+    "temp_directory": "/scratch"} to spill to disk, or {"threads": 8}.
+    Unselected columns leave their lookup tables empty, so gender, date formats and
+    tag names are only built when requested. Returns the same four frames as
+    clean_dataframe.
+    """
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb backend requires the duckdb package: pip install duckdb") from e
+
+    output_columns = _output_columns(tag_format, columns)
+    subset = _select_input_subset(df)
+
+    raw_rows = pd.DataFrame(
+        {
+            "row_id": np.arange(len(subset), dtype=np.int64),
+            "national_id_raw": _as_sql_text(subset["national_id_raw"]),
+            "full_name": _as_sql_text(subset["full_name"]),
+            "mobile_raw": _as_sql_text(subset["mobile_raw"]),
+            "visit_date_parsed": _as_sql_timestamps(map_unique(subset["visit_date_raw"], parse_visit_date)),
+            "status_raw": _as_sql_text(subset["status_raw"]),
+            "appointment_type_raw": _as_sql_text(subset["appointment_type_raw"]),
+            "clinic_raw": _as_sql_text(subset["clinic_raw"]),
+        }
+    )
+
+    history_rows = pd.DataFrame(
+        {
+            "row_id": pd.Series(dtype="int64"),
+            "national_id": pd.Series(dtype=object),
+            "first_name": pd.Series(dtype=object),
+            "last_name": pd.Series(dtype=object),
+            "visit_date_parsed": pd.Series(dtype="datetime64[us]"),
+        }
+    )
+    if name_history is not None and not name_history.empty:
+        history_rows = pd.DataFrame(
+            {
+                "row_id": np.arange(len(subset), len(subset) + len(name_history), dtype=np.int64),
+                "national_id": name_history["national_id"].astype(object).to_numpy(),
+                "first_name": name_history["first_name"].astype(object).to_numpy(),
+                "last_name": name_history["last_name"].astype(object).to_numpy(),
+                "visit_date_parsed": _as_sql_timestamps(name_history["visit_date_parsed"]),
+            }
+        )
+        LOGGER.info("Added %d out-of-window rows for name completion", len(name_history))
+
+    parsed_dates = pd.Series(pd.unique(raw_rows["visit_date_parsed"].dropna()), dtype="datetime64[us]")
+    date_formats = pd.DataFrame(
+        {
+            "visit_date_parsed": parsed_dates,
+            **{
+                column: (
+                    parsed_dates.map(formatter)
+                    if column in output_columns
+                    else pd.Series(pd.NA, index=parsed_dates.index)
+                ).astype(object)
+                for column, formatter in VISIT_DATE_FORMATTERS.items()
+            },
+        }
+    )
+
+    tag_sources = pd.DataFrame(
+        [
+            (source, key, TAG_BITS[tag])
+            for source, tag_map in (
+                ("status", STATUS_TAG_MAP),
+                ("appointment_type", APPOINTMENT_TYPE_TAG_MAP),
+                ("clinic", CLINIC_TAG_MAP),
+            )
+            for key, tag in tag_map.items()
+        ],
+        columns=["source", "key", "bit"],
+    )
+    tag_registry = pd.DataFrame(
+        [
+            (position, tag, TAG_BITS[tag])
+            for position, tag in enumerate(TAG_DISPLAY_ORDER)
+            if tag_format == "string" and "tags" in output_columns
+        ],
+        columns=["position", "tag", "bit"],
+    ).astype({"position": "int64", "tag": object, "bit": "int64"})
+    gender_lookup = pd.DataFrame(
+        [item for item in PERSIAN_GENDER_LOOKUP.items() if "gender" in output_columns],
+        columns=["name", "gender"],
+        dtype=object,
+    )
+
+    connection = duckdb.connect(config=dict(config or {}))
+    try:
+        for name, frame in (
+            ("raw_rows", raw_rows),
+            ("history_rows", history_rows),
+            ("date_formats", date_formats),
+            ("tag_sources", tag_sources),
+            ("tag_registry", tag_registry),
+            ("gender_lookup", gender_lookup),
+        ):
+            connection.register(f"{name}_frame", frame)
+            casts = ", ".join(
+                f"CAST({_quote_identifier(column)} AS {sql_type}) AS {_quote_identifier(column)}"
+                for column, sql_type in DUCKDB_INPUT_SCHEMAS[name].items()
+            )
+            connection.execute(f"CREATE TEMP VIEW {name} AS SELECT {casts} FROM {name}_frame")
+        connection.execute(DUCKDB_MACROS)
+        connection.execute(DUCKDB_CLEAN_QUERY)
+
+        def fetch(disposition: str, columns: list[str]) -> pd.DataFrame:
+            frame = connection.execute(
+                f"SELECT {', '.join(columns)} FROM outputs WHERE disposition = ? ORDER BY national_id",
+                [disposition],
+            ).df()
+            return frame.astype(object).where(frame.notna(), pd.NA)
+
+        cleaned_output = fetch("cleaned", output_columns)
+        excluded_output = fetch("excluded", ["full_name", *output_columns, "exclusion_reason"])
+        duplicate_phone_output = fetch("duplicate_phone", output_columns)
+        incomplete_name_output = fetch("incomplete_name", output_columns)
+        (dropped,) = connection.execute(
+            "SELECT count(*) FROM outputs WHERE disposition IS NULL"
+        ).fetchone()
+    finally:
+        connection.close()
+
+    if "tag_mask" in output_columns:
+        for frame in (cleaned_output, excluded_output, duplicate_phone_output, incomplete_name_output):
+            frame["tag_mask"] = frame["tag_mask"].astype("int64")
+
+    LOGGER.info(
+        "Enhanced deduplication: %d complete records, %d incomplete records",
+        len(cleaned_output) + len(excluded_output) + len(duplicate_phone_output) + dropped,
+        len(incomplete_name_output),
+    )
+    if not excluded_output.empty:
+        LOGGER.info("Moved %d rows with invalid names to excluded set", len(excluded_output))
+    if dropped:
+        LOGGER.warning("Dropping %d rows missing required fields", dropped)
+    if not duplicate_phone_output.empty:
+        LOGGER.info("Found %d records with duplicate phone numbers", len(duplicate_phone_output))
+    if not incomplete_name_output.empty:
+        LOGGER.info("Found %d records with incomplete names that couldn't be completed", len(incomplete_name_output))
+
+    _log_normalizer_stats()
+
+    return cleaned_output, excluded_output, duplicate_phone_output, incomplete_name_output
+
+
+def check_backend_parity(
+    df: pd.DataFrame,
+    config: Mapping[str, object] | None = None,
+    tag_format: str = "string",
+    name_history: pd.DataFrame | None = None,
+    columns: Iterable[str] | None = None,
+) -> list[str]:
+    """
+    Run both backends on df with the same options and describe every output
+    frame that differs (empty list on parity).
+    """
+    names = ("cleaned", "excluded", "duplicate_phone", "incomplete_name")
+
+    def comparable(frame: pd.DataFrame) -> pd.DataFrame:
+        text = frame.astype(object).where(frame.notna(), None).astype(str)
+        return text.sort_values(list(text.columns)).reset_index(drop=True)
+
+    mismatches = []
+    clean_options = {"tag_format": tag_format, "name_history": name_history, "columns": columns}
+    pandas_outputs = clean_dataframe(df, **clean_options)
+    duckdb_outputs = clean_dataframe_duckdb(df, config=config, **clean_options)
+    for name, expected, actual in zip(names, pandas_outputs, duckdb_outputs):
+        try:
+            pd.testing.assert_frame_equal(comparable(expected), comparable(actual), check_dtype=False)
+        except AssertionError as e:
+            mismatches.append(f"{name}: {e}")
+    return mismatches
+
+
+def _count_excel_rows(input_file: Path) -> int | None:
+    """Data row count of the first sheet (the one read_excel reads) from its dimensions, without loading the cells."""
+    try:
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(input_file, read_only=True)
+        try:
+            max_row = workbook.worksheets[0].max_row
+        finally:
+            workbook.close()
+    except Exception as e:
+        LOGGER.debug("Cannot count rows in %s: %s", input_file, e)
+        return None
+    return max(max_row - 1, 0) if max_row else None
+
+
+def _sample_skiprows(sample_fraction: float, seed: int):
+    """Reproducible row filter for read_excel: the same rows are kept on every run with the same seed."""
+    if not 0 < sample_fraction <= 1:
+        raise ValueError(f"Sample fraction must be in (0, 1], got {sample_fraction}")
+    threshold = int(sample_fraction * 0xFFFFFFFF)
+
+    def skip(row_number: int) -> bool:
+        if row_number == 0:
+            return False
+        return zlib.crc32(f"{seed}:{row_number}".encode()) > threshold
+
+    return skip
+
+
+def parse_date_bound(value: str) -> pd.Timestamp:
+    """argparse type for --since/--until: a Jalali or Gregorian date, optionally with time."""
+    parsed = parse_visit_date(value)
+    if pd.isna(parsed):
+        raise argparse.ArgumentTypeError(f"Cannot parse date {value!r}; use e.g. 1403/05/01 or 2024-07-22.")
+    return parsed
+
+
+def parse_output_columns(value: str) -> list[str]:
+    """argparse type for --columns: a comma-separated list of OUTPUT_COLUMNS."""
+    columns = [column.strip() for column in value.split(",") if column.strip()]
+    try:
+        _output_columns("string", columns)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+    return columns
+
+
+class DateWindow:
+    """
+    Keeps rows whose تاریخ اخذ falls in [since, until] at read time, before any
+    other normalization. Rows without a parseable date are kept. With
+    keep_history, out-of-window rows with a complete name are kept as a small
+    national_id / name / date frame for name completion.
+    """
+
+    def __init__(
+        self,
+        since: pd.Timestamp | None = None,
+        until: pd.Timestamp | None = None,
+        keep_history: bool = False,
+    ) -> None:
+        if since is not None and until is not None and since > until:
+            raise ValueError(f"Date window is empty: since {since} is after until {until}")
+        self.since = since
+        # A date-only bound covers the whole day
+        if until is not None and until == until.normalize():
+            until = until + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1)
+        self.until = until
+        self.keep_history = keep_history
+        self.rows_seen = 0
+        self._history: list[pd.DataFrame] = []
+
+    def filter(self, df: pd.DataFrame, source: str) -> pd.DataFrame:
+        self.rows_seen += len(df)
+        date_column = _select_optional_columns(df.columns).get("visit_date")
+        if date_column is None:
+            LOGGER.warning("%s has no visit date column; date window not applied", source)
+            return df
+
+        parsed = map_unique(df[date_column], parse_visit_date)
+        outside = pd.Series(False, index=df.index)
+        if self.since is not None:
+            outside |= parsed < self.since
+        if self.until is not None:
+            outside |= parsed > self.until
+
+        if self.keep_history and outside.any():
+            self._history.append(self._lightweight(df[outside], parsed[outside]))
+        LOGGER.info("%s: kept %d of %d rows inside the date window", source, int((~outside).sum()), len(df))
+        return df[~outside]
+
+    @staticmethod
+    def _lightweight(df: pd.DataFrame, parsed: pd.Series) -> pd.DataFrame:
+        selectors = _select_columns(df.columns)
+        name_parts = map_unique(df[selectors["full_name"]], split_full_name)
+        history = pd.DataFrame(
+            {
+                "national_id": map_unique(df[selectors["national_id"]], clean_national_id),
+                "first_name": [parts[0] for parts in name_parts],
+                "last_name": [parts[1] for parts in name_parts],
+                "visit_date_parsed": parsed,
+            },
+            index=df.index,
+        )
+        complete = [
+            _is_name_complete(first, last) for first, last in zip(history["first_name"], history["last_name"])
+        ]
+        return history[history["national_id"].notna() & pd.Series(complete, index=history.index)]
+
+    def history_frame(self) -> pd.DataFrame | None:
+        if not self._history:
+            return None
+        return pd.concat(self._history, ignore_index=True)
+
+
+class SeenRowIndex:
+    """
+    Hashes of rows already ingested, over the columns picked by _select_columns
+    and _select_optional_columns. Lets overlapping exports (e.g. a weekly file and
+    the monthly file) skip exact duplicates before any normalization, and can be
+    saved to disk so later runs skip rows seen before.
+    """
+
+    def __init__(self, hashes: np.ndarray | None = None) -> None:
+        self._hashes = np.unique(hashes) if hashes is not None else np.empty(0, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    @classmethod
+    def load(cls, path: Path) -> "SeenRowIndex":
+        if not path.exists():
+            LOGGER.info("No seen-rows index at %s; starting a new one", path)
+            return cls()
+        with open(path, "rb") as f:
+            hashes = np.load(f)
+        LOGGER.info("Loaded %d seen row hashes from %s", len(hashes), path)
+        return cls(hashes.astype(np.uint64))
+
+    def save(self, path: Path) -> None:
+        with open(path, "wb") as f:
+            np.save(f, self._hashes)
+        LOGGER.info("Saved %d seen row hashes to %s", len(self._hashes), path)
+
+    @staticmethod
+    def row_hashes(df: pd.DataFrame) -> np.ndarray:
+        selectors = {**_select_columns(df.columns), **_select_optional_columns(df.columns)}
+        # Keyed by target name and compared as text, so files with different
+        # header aliases or cell dtypes still hash the same row identically.
+        keyed = pd.DataFrame({target: df[selectors[target]].astype(str) for target in sorted(selectors)})
+        return pd.util.hash_pandas_object(keyed, index=False).to_numpy(dtype=np.uint64)
+
+    def filter_new(self, df: pd.DataFrame, source: str) -> pd.DataFrame:
+        """Drop rows of df seen earlier (in df itself or a previous input) and record them as seen."""
+        hashes = self.row_hashes(df)
+        new_mask = ~pd.Series(hashes).duplicated().to_numpy() & ~np.isin(hashes, self._hashes)
+        self._hashes = np.union1d(self._hashes, hashes[new_mask])
+        new_rows = int(new_mask.sum())
+        LOGGER.info(
+            "%s contributed %d new rows of %d (%d exact duplicates dropped)",
+            source, new_rows, len(df), len(df) - new_rows,
+        )
+        return df[new_mask]
+
+
+def read_input_file(
+    input_file: Path,
+    nrows: int | None = None,
+    sample_fraction: float | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Read one Excel export, optionally only its first nrows rows or a reproducible random sample."""
+    if not input_file.exists():
+        raise FileNotFoundError(f"Cannot find input file: {input_file}")
+
+    LOGGER.info("Reading input file %s", input_file)
+    skiprows = _sample_skiprows(sample_fraction, seed) if sample_fraction is not None else None
+    return pd.read_excel(input_file, nrows=nrows, skiprows=skiprows)
+
+
+def merge_dataframes(
+    input_files: list[Path],
+    nrows: int | None = None,
+    sample_fraction: float | None = None,
+    seed: int = 0,
+    seen_rows: SeenRowIndex | None = None,
+    date_window: DateWindow | None = None,
+) -> pd.DataFrame:
+    """
+    Read and merge multiple Excel files into a single DataFrame. Rows outside
+    date_window and exact duplicate rows are dropped as each file is read; pass
+    seen_rows to carry the duplicates across runs.
+    """
     all_dataframes: list[pd.DataFrame] = []
+    if seen_rows is None:
+        seen_rows = SeenRowIndex()
 
     for input_file in input_files:
-        if not input_file.exists():
-            raise FileNotFoundError(f"Cannot find input file: {input_file}")
-
-        LOGGER.info("Reading input file %s", input_file)
-        df = pd.read_excel(input_file)
-        all_dataframes.append(df)
+        df = read_input_file(input_file, nrows=nrows, sample_fraction=sample_fraction, seed=seed)
+        if date_window is not None:
+            df = date_window.filter(df, input_file.name)
+        all_dataframes.append(seen_rows.filter_new(df, input_file.name))
 
     if not all_dataframes:
         raise ValueError("No input files provided")
@@ -819,15 +1894,237 @@ def merge_dataframes(input_files: list[Path]) -> pd.DataFrame:
     return merged_df
 
 
-def export_dataframe(df: pd.DataFrame, output_path: Path) -> None:
-    if output_path.suffix.casefold() in {".xlsx", ".xlsm", ".xls"}:
-        df.to_excel(output_path, index=False)
-    elif output_path.suffix.casefold() == ".csv":
-        df.to_csv(output_path, index=False)
+def preview_run(
+    input_files: list[Path],
+    preview_rows: int | None = None,
+    sample_fraction: float | None = None,
+    seed: int = 0,
+    tag_format: str = "string",
+    columns: Iterable[str] | None = None,
+    date_window: DateWindow | None = None,
+    backend: str = "pandas",
+    duckdb_config: Mapping[str, object] | None = None,
+) -> dict[str, object]:
+    """
+    Clean only the first preview_rows rows (per file) or a sample_fraction sample
+    and report header and date detection, the disposition breakdown and a
+    projected full-run time. Nothing is written. date_window is applied as in a
+    full run, so the report reflects the windowed rows. backend ("pandas" or
+    "duckdb") selects the engine that is timed.
+
+    Reading and cleaning are timed separately: cleaning is scaled up to the full
+    row count, reading only for preview_rows, since a sampled read still parses
+    every row of the workbook.
+    """
+    if backend not in {"pandas", "duckdb"}:
+        raise ValueError(f"Unsupported backend {backend!r}. Use 'pandas' or 'duckdb'.")
+    started = time.perf_counter()
+    df = merge_dataframes(
+        input_files, nrows=preview_rows, sample_fraction=sample_fraction, seed=seed, date_window=date_window
+    )
+    read_seconds = time.perf_counter() - started
+    selected = {**_select_columns(df.columns), **_select_optional_columns(df.columns)}
+    clean_options = {
+        "tag_format": tag_format,
+        "columns": columns,
+        "name_history": date_window.history_frame() if date_window is not None else None,
+    }
+    if backend == "duckdb":
+        cleaned, excluded, duplicate_phone, incomplete_name = clean_dataframe_duckdb(
+            df, config=duckdb_config, **clean_options
+        )
+    else:
+        cleaned, excluded, duplicate_phone, incomplete_name = clean_dataframe(df, **clean_options)
+    clean_seconds = time.perf_counter() - started - read_seconds
+
+    if "visit_date" in selected:
+        parsed_dates = map_unique(df[selected["visit_date"]], parse_visit_date)
+    else:
+        parsed_dates = pd.Series(pd.NaT, index=df.index)
+
+    row_counts = [_count_excel_rows(input_file) for input_file in input_files]
+    total_rows = None if None in row_counts else sum(row_counts)
+    projected_seconds = None
+    # Rows read before the date window, which is what the input row count measures
+    rows_scanned = date_window.rows_seen if date_window is not None else len(df)
+    if total_rows is not None and rows_scanned:
+        scale = total_rows / rows_scanned
+        projected_read_seconds = read_seconds if sample_fraction is not None else read_seconds * scale
+        projected_seconds = projected_read_seconds + clean_seconds * scale
+
+    dispositions = {
+        "cleaned": len(cleaned),
+        "excluded": len(excluded),
+        "duplicate_phone": len(duplicate_phone),
+        "incomplete_name": len(incomplete_name),
+    }
+    # Rows collapsed by deduplication or dropped for missing required fields
+    dispositions["merged_or_dropped"] = len(df) - sum(dispositions.values())
+
+    return {
+        "backend": backend,
+        "rows_read": len(df),
+        "total_rows": total_rows,
+        "columns": selected,
+        "dates_parsed": int(parsed_dates.notna().sum()),
+        "dates_unparsed": int(parsed_dates.isna().sum()),
+        "date_min": parsed_dates.min(),
+        "date_max": parsed_dates.max(),
+        "dispositions": dispositions,
+        "read_seconds": read_seconds,
+        "clean_seconds": clean_seconds,
+        "elapsed_seconds": read_seconds + clean_seconds,
+        "projected_seconds": projected_seconds,
+    }
+
+
+def print_preview_report(report: Mapping[str, object]) -> None:
+    rows_read = report["rows_read"]
+    total_rows = report["total_rows"]
+    print(f"Rows read: {rows_read}" + (f" of {total_rows}" if total_rows is not None else ""))
+    print("Detected columns:")
+    for target, column in report["columns"].items():
+        print(f"  {target:<18} <- {column}")
+    print(
+        f"Visit dates: {report['dates_parsed']} parsed, {report['dates_unparsed']} unparsed"
+        f" (range {format_visit_date(report['date_min'])} .. {format_visit_date(report['date_max'])})"
+    )
+    print("Dispositions:")
+    for name, count in report["dispositions"].items():
+        share = count / rows_read * 100 if rows_read else 0.0
+        print(f"  {name:<18} {count:>8} ({share:5.1f}%)")
+    print(f"Backend: {report['backend']}")
+    print(
+        f"Elapsed: {report['elapsed_seconds']:.2f}s"
+        f" (read {report['read_seconds']:.2f}s, clean {report['clean_seconds']:.2f}s)"
+    )
+    if report["projected_seconds"] is not None:
+        print(f"Projected full run: {report['projected_seconds']:.1f}s")
     else:
+        print("Projected full run: unknown (row count unavailable)")
+
+
+OUTPUT_FORMAT_SUFFIXES: Mapping[str, Tuple[str, ...]] = {
+    "xlsx": (".xlsx", ".xlsm", ".xls"),
+    "csv": (".csv",),
+    "sqlite": (".sqlite", ".sqlite3", ".db"),
+    "pgcopy": (".copy", ".pgcopy"),
+    "ndjson": (".ndjson", ".jsonl"),
+}
+
+STDOUT_PATH = Path("-")
+STREAMABLE_FORMATS: Tuple[str, ...] = ("csv", "pgcopy", "ndjson")
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_SQLITE_TABLE = "appointments"
+
+PGCOPY_ESCAPE_MAP = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _infer_output_format(output_path: Path) -> str:
+    if output_path == STDOUT_PATH:
+        return "ndjson"
+    suffix = output_path.suffix.casefold()
+    for output_format, suffixes in OUTPUT_FORMAT_SUFFIXES.items():
+        if suffix in suffixes:
+            return output_format
+    supported = ", ".join(f"'{item}'" for suffixes in OUTPUT_FORMAT_SUFFIXES.values() for item in suffixes)
+    raise ValueError(f"Unsupported output format '{output_path.suffix}'. Use {supported}.")
+
+
+def resolve_output_format(output_path: Path, output_format: str | None = None) -> str:
+    """The output format for output_path; raises ValueError if it cannot be streamed to stdout ("-")."""
+    output_format = output_format or _infer_output_format(output_path)
+    if output_format not in OUTPUT_FORMAT_SUFFIXES:
+        raise ValueError(f"Unsupported output format '{output_format}'. Use one of {tuple(OUTPUT_FORMAT_SUFFIXES)}.")
+    if output_path == STDOUT_PATH and output_format not in STREAMABLE_FORMATS:
         raise ValueError(
-            f"Unsupported output format '{output_path.suffix}'. Use '.xlsx', '.xls', '.xlsm', or '.csv'."
+            f"{output_format} output cannot be streamed to stdout; use one of {STREAMABLE_FORMATS} "
+            "or give a file path."
         )
+    return output_format
+
+
+def _iter_record_batches(df: pd.DataFrame, batch_size: int) -> Iterable[list[tuple]]:
+    """Yield rows as plain tuples (missing values as None), batch_size rows at a time."""
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be positive, got {batch_size}")
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield list(chunk.itertuples(index=False, name=None))
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _export_sqlite(df: pd.DataFrame, output_path: Path, table: str, batch_size: int) -> None:
+    columns = [str(column) for column in df.columns]
+    column_sql = ", ".join(f"{_quote_identifier(column)} TEXT" for column in columns)
+    insert_sql = (
+        f"INSERT INTO {_quote_identifier(table)} ({', '.join(map(_quote_identifier, columns))}) "
+        f"VALUES ({', '.join('?' for _ in columns)})"
+    )
+    connection = sqlite3.connect(output_path)
+    try:
+        with connection:
+            connection.execute(f"DROP TABLE IF EXISTS {_quote_identifier(table)}")
+            connection.execute(f"CREATE TABLE {_quote_identifier(table)} ({column_sql})")
+            for batch in _iter_record_batches(df, batch_size):
+                connection.executemany(insert_sql, batch)
+    finally:
+        connection.close()
+
+
+def _format_pgcopy_value(value: object) -> str:
+    if value is None:
+        return "\\N"
+    return str(value).translate(PGCOPY_ESCAPE_MAP)
+
+
+def _write_pgcopy(df: pd.DataFrame, stream: TextIO, batch_size: int) -> None:
+    """Write rows in PostgreSQL COPY text format (tab separated, \\N for NULL, no header)."""
+    for batch in _iter_record_batches(df, batch_size):
+        stream.write("".join("\t".join(map(_format_pgcopy_value, row)) + "\n" for row in batch))
+        stream.flush()
+
+
+def _write_ndjson(df: pd.DataFrame, stream: TextIO, batch_size: int) -> None:
+    columns = [str(column) for column in df.columns]
+    for batch in _iter_record_batches(df, batch_size):
+        stream.write("".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in batch))
+        stream.flush()
+
+
+def export_dataframe(
+    df: pd.DataFrame,
+    output_path: Path,
+    output_format: str | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    table: str = DEFAULT_SQLITE_TABLE,
+) -> None:
+    """
+    Write df to output_path. The format is inferred from the suffix unless given.
+    sqlite, pgcopy and ndjson are written in batches of batch_size rows; csv, pgcopy
+    and ndjson stream to stdout when output_path is "-". sqlite replaces only
+    table, so several tables can share one database file. A tag_mask column is
+    rendered to the tags string here.
+    """
+    output_format = resolve_output_format(output_path, output_format)
+    df = expand_tag_masks(df)
+    if output_format == "xlsx":
+        df.to_excel(output_path, index=False)
+    elif output_format == "csv":
+        df.to_csv(sys.stdout if output_path == STDOUT_PATH else output_path, index=False, chunksize=batch_size)
+    elif output_format == "sqlite":
+        _export_sqlite(df, output_path, table, batch_size)
+    else:
+        writer = _write_pgcopy if output_format == "pgcopy" else _write_ndjson
+        if output_path == STDOUT_PATH:
+            writer(df, sys.stdout, batch_size)
+        else:
+            with open(output_path, "w", encoding="utf-8", newline="\n") as stream:
+                writer(df, stream, batch_size)
 
 
 def parse_args() -> argparse.Namespace:
@@ -839,59 +2136,229 @@ def parse_args() -> argparse.Namespace:
         "-o",
         "--output",
         type=Path,
-        help="Destination file (defaults to <input_stem>_cleaned.xlsx).",
+        help="Destination file (defaults to <input_stem>_cleaned.xlsx). Use '-' to stream to stdout.",
+    )
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=list(OUTPUT_FORMAT_SUFFIXES),
+        help="Output format (defaults to the output suffix; ndjson when streaming to stdout).",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Rows per batch for sqlite, pgcopy and ndjson output (default: {DEFAULT_BATCH_SIZE}).",
+    )
+    parser.add_argument(
+        "--table",
+        default=DEFAULT_SQLITE_TABLE,
+        help=(
+            f"Table name for sqlite output (default: {DEFAULT_SQLITE_TABLE}); side outputs go to "
+            "<table>_excluded, <table>_duplicate_phone and <table>_incomplete_name in the same database."
+        ),
     )
     parser.add_argument(
         "--overwrite",
         action="store_true",
         help="Allow overwriting an existing output file.",
     )
+    parser.add_argument(
+        "--since",
+        type=parse_date_bound,
+        metavar="DATE",
+        help="Only keep rows whose visit date is on or after DATE (Jalali or Gregorian).",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_date_bound,
+        metavar="DATE",
+        help="Only keep rows whose visit date is on or before DATE (Jalali or Gregorian).",
+    )
+    parser.add_argument(
+        "--keep-history-names",
+        action="store_true",
+        help="Keep national ID and name of rows outside --since/--until to complete names.",
+    )
+    parser.add_argument(
+        "--seen-rows",
+        type=Path,
+        metavar="PATH",
+        help="Index of row hashes from earlier runs; rows already in it are skipped and it is updated after writing.",
+    )
+    parser.add_argument(
+        "--backend",
+        default="pandas",
+        choices=["pandas", "duckdb"],
+        help="Cleaning engine (default: pandas). duckdb needs the duckdb package.",
+    )
+    parser.add_argument(
+        "--duckdb-threads",
+        type=int,
+        help="Threads for the duckdb backend (default: all cores).",
+    )
+    parser.add_argument(
+        "--duckdb-memory-limit",
+        help="Memory limit for the duckdb backend, e.g. 4GB; larger intermediates spill to disk.",
+    )
+    parser.add_argument(
+        "--duckdb-temp-dir",
+        type=Path,
+        help="Spill directory for the duckdb backend.",
+    )
+    parser.add_argument(
+        "--check-parity",
+        action="store_true",
+        help="Clean the input with both backends, report any differences and write nothing.",
+    )
+    parser.add_argument(
+        "--columns",
+        type=parse_output_columns,
+        metavar="COLUMNS",
+        help=(
+            "Comma-separated output columns, e.g. national_id,first_name,last_name,mobile "
+            f"(default: all of {','.join(OUTPUT_COLUMNS)}). Unselected derived columns are not computed."
+        ),
+    )
+    parser.add_argument(
+        "--tag-mask",
+        action="store_true",
+        help="Keep tags as an integer bitmask while cleaning; the tags string is only built at export.",
+    )
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument(
+        "--preview",
+        type=int,
+        metavar="N",
+        help="Clean only the first N rows of each input, print a report and write nothing.",
+    )
+    sampling.add_argument(
+        "--sample",
+        type=float,
+        metavar="FRACTION",
+        help="Clean a reproducible random FRACTION of rows, print a report and write nothing.",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed for --sample (default: 0).",
+    )
     parser.add_argument(
         "--log-level",
         default="INFO",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Set the verbosity of log messages (default: INFO).",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.keep_history_names and args.since is None and args.until is None:
+        parser.error("--keep-history-names requires --since and/or --until")
+    return args
 
 
 def main() -> None:
     args = parse_args()
     logging.basicConfig(level=getattr(logging, args.log_level.upper()), format="%(levelname)s: %(message)s")
 
-    # Merge all input files
-    df = merge_dataframes(args.input)
+    tag_format = "mask" if args.tag_mask else "string"
+    date_window = None
+    if args.since is not None or args.until is not None:
+        date_window = DateWindow(args.since, args.until, keep_history=args.keep_history_names)
+
+    duckdb_config: dict[str, object] = {}
+    if args.duckdb_threads:
+        duckdb_config["threads"] = args.duckdb_threads
+    if args.duckdb_memory_limit:
+        duckdb_config["memory_limit"] = args.duckdb_memory_limit
+    if args.duckdb_temp_dir:
+        duckdb_config["temp_directory"] = str(args.duckdb_temp_dir)
+
+    if args.preview is not None or args.sample is not None:
+        report = preview_run(
+            args.input,
+            preview_rows=args.preview,
+            sample_fraction=args.sample,
+            seed=args.sample_seed,
+            tag_format=tag_format,
+            columns=args.columns,
+            date_window=date_window,
+            backend=args.backend,
+            duckdb_config=duckdb_config,
+        )
+        print_preview_report(report)
+        return
+
+    if args.check_parity:
+        mismatches = check_backend_parity(
+            merge_dataframes(args.input, date_window=date_window),
+            config=duckdb_config,
+            tag_format=tag_format,
+            name_history=date_window.history_frame() if date_window is not None else None,
+            columns=args.columns,
+        )
+        for mismatch in mismatches:
+            print(mismatch)
+        print("Backends differ" if mismatches else "Backends produce identical output")
+        return
 
     output = args.output
     if output is None:
+        suffix = OUTPUT_FORMAT_SUFFIXES[args.output_format or "xlsx"][0]
         if len(args.input) == 1:
-            output = args.input[0].with_name(f"{args.input[0].stem}_cleaned.xlsx")
+            output = args.input[0].with_name(f"{args.input[0].stem}_cleaned{suffix}")
         else:
-            output = Path("merged_cleaned.xlsx")
+            output = Path(f"merged_cleaned{suffix}")
+    output_format = resolve_output_format(output, args.output_format)
 
-    if output.exists() and not args.overwrite:
+    if output != STDOUT_PATH and output.exists() and not args.overwrite:
         raise FileExistsError(f"Output file already exists: {output}. Use --overwrite to replace it.")
 
+    # Merge all input files
+    seen_rows = SeenRowIndex.load(args.seen_rows) if args.seen_rows else SeenRowIndex()
+    df = merge_dataframes(args.input, seen_rows=seen_rows, date_window=date_window)
+
     LOGGER.info("Cleaning data")
-    cleaned, excluded, duplicate_phone, incomplete_name = clean_dataframe(df)
+    clean_options = {
+        "tag_format": tag_format,
+        "columns": args.columns,
+        "name_history": date_window.history_frame() if date_window is not None else None,
+    }
+    if args.backend == "duckdb":
+        cleaned, excluded, duplicate_phone, incomplete_name = clean_dataframe_duckdb(
+            df, config=duckdb_config, **clean_options
+        )
+    else:
+        cleaned, excluded, duplicate_phone, incomplete_name = clean_dataframe(df, **clean_options)
+
+    export_options = {"output_format": output_format, "batch_size": args.batch_size}
 
     LOGGER.info("Writing %d rows to %s", len(cleaned), output)
-    export_dataframe(cleaned, output)
+    export_dataframe(cleaned, output, table=args.table, **export_options)
 
-    if not excluded.empty:
-        excluded_output = output.with_name(f"{output.stem}_excluded{output.suffix}")
-        LOGGER.info("Writing %d excluded rows to %s", len(excluded), excluded_output)
-        export_dataframe(excluded, excluded_output)
-
-    if not duplicate_phone.empty:
-        duplicate_phone_output = output.with_name(f"{output.stem}_duplicate_phone{output.suffix}")
-        LOGGER.info("Writing %d duplicate phone records to %s", len(duplicate_phone), duplicate_phone_output)
-        export_dataframe(duplicate_phone, duplicate_phone_output)
-
-    if not incomplete_name.empty:
-        incomplete_name_output = output.with_name(f"{output.stem}_incomplete_name{output.suffix}")
-        LOGGER.info("Writing %d incomplete name records to %s", len(incomplete_name), incomplete_name_output)
-        export_dataframe(incomplete_name, incomplete_name_output)
+    if args.seen_rows:
+        seen_rows.save(args.seen_rows)
+
+    if output == STDOUT_PATH:
+        LOGGER.info(
+            "Streaming to stdout; skipped %d excluded, %d duplicate phone and %d incomplete name rows",
+            len(excluded), len(duplicate_phone), len(incomplete_name),
+        )
+        return
+
+    for name, frame in (
+        ("excluded", excluded),
+        ("duplicate_phone", duplicate_phone),
+        ("incomplete_name", incomplete_name),
+    ):
+        if output_format == "sqlite":
+            # Side outputs go to their own tables in the same database (replacing stale ones)
+            table = f"{args.table}_{name}"
+            LOGGER.info("Writing %d %s rows to table %s in %s", len(frame), name, table, output)
+            export_dataframe(frame, output, table=table, **export_options)
+        elif not frame.empty:
+            side_output = output.with_name(f"{output.stem}_{name}{output.suffix}")
+            LOGGER.info("Writing %d %s rows to %s", len(frame), name, side_output)
+            export_dataframe(frame, side_output, **export_options)
 
 
 if __name__ == "__main__":